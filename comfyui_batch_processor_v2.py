@@ -1,34 +1,379 @@
+import copy
+import asyncio
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import websocket
 import uuid
 import time
 import os
 import re
 import random
-from datetime import datetime
+import queue
+import threading
 import logging
+import logging.handlers
 from pathlib import Path
 
-class ComfyUIBatchProcessorV2:
-    def __init__(self, server_address="127.0.0.1:8188"):
+try:
+    import orjson
+except ImportError:  # orjson opsional, fallback ke json bawaan
+    orjson = None
+
+
+def _json_dumps(obj):
+    """Serialisasi ke bytes UTF-8 (orjson bila tersedia)"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+
+def _json_loads(data):
+    """Parse JSON dari str/bytes (orjson bila tersedia)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _copy_workflow(workflow):
+    """Salinan dalam dari workflow JSON; round-trip orjson lebih cepat dari deepcopy"""
+    if orjson is not None:
+        return orjson.loads(orjson.dumps(workflow))
+    return copy.deepcopy(workflow)
+
+
+# Format baris prompt: [∆{workflow}•jumlah∆ ¥prompt¥]
+_WORKFLOW_RE = re.compile(r'∆\{([^}]+)\}•(\d+)∆')
+_SPLIT_SEP = ' ¥'
+
+# Penanda di body /prompt yang sudah diserialisasi, diganti per gambar
+_TEXT_SENTINEL = '__COMFYUI_BATCH_PROMPT_TEXT__'
+_SEED_SENTINEL = '__COMFYUI_BATCH_SEED_{}__'
+
+
+def _parse_workflow_part(workflow_part):
+    """Memecah '∆{nama}•jumlah∆...' menjadi [(nama, jumlah), ...] tanpa regex
+
+    Baris yang bentuknya menyimpang diserahkan ke _WORKFLOW_RE agar hasilnya tetap sama.
+    """
+    try:
+        pieces = workflow_part.split('∆')
+        if len(pieces) % 2 == 0:
+            raise ValueError("tanda '∆' tidak berpasangan")
+        matches = []
+        for piece in pieces[1::2]:
+            name, count = piece.split('•')
+            if len(name) < 3 or name[0] != '{' or name[-1] != '}' or '}' in name[1:-1] or not count.isdecimal():
+                raise ValueError(f"format workflow tidak dikenal: {piece!r}")
+            matches.append((name[1:-1], count))
+        return matches
+    except ValueError:
+        return _WORKFLOW_RE.findall(workflow_part)
+
+
+class _InflightLimitMixin:
+    """Batas pekerjaan berjalan per server: dibagi dua bila timeout beruntun, naik lagi setelah cukup banyak sukses"""
+
+    TIMEOUTS_BEFORE_BACKOFF = 2
+    SUCCESSES_BEFORE_RECOVERY = 8
+
+    def _init_inflight_limit(self, max_inflight):
+        self.max_inflight = self._configured_max_inflight = max_inflight
+        self._slots = None
+        self._slot_debt = 0
+        self._consecutive_timeouts = 0
+        self._consecutive_successes = 0
+        self._last_backoff = float('-inf')
+
+    def _create_slots(self, semaphore_cls):
+        self.max_inflight = self._configured_max_inflight
+        self._slots = semaphore_cls(self.max_inflight)
+        self._slot_debt = 0
+
+    def release_slot(self):
+        # Slot yang dicabut saat batas diturunkan tidak dikembalikan ke semaphore
+        if self._slot_debt:
+            self._slot_debt -= 1
+        else:
+            self._slots.release()
+
+    def record_result(self, finished, submitted_at=None):
+        """Mencatat hasil satu pekerjaan dan menyesuaikan max_inflight
+
+        Timeout dari pekerjaan yang dikirim sebelum penurunan terakhir berasal dari
+        jendela yang sama, jadi tidak dihitung lagi; satu kali macet = satu kali turun.
+        """
+        if finished:
+            self._consecutive_timeouts = 0
+            self._consecutive_successes += 1
+            if (self._consecutive_successes >= self.SUCCESSES_BEFORE_RECOVERY
+                    and self.max_inflight < self._configured_max_inflight):
+                self._consecutive_successes = 0
+                self.max_inflight += 1
+                if self._slot_debt:
+                    self._slot_debt -= 1
+                else:
+                    self._slots.release()
+                self.logger.info("Server %s pulih, max_inflight dinaikkan ke %d", self.server_address, self.max_inflight)
+            return
+
+        self._consecutive_successes = 0
+        if submitted_at is not None and submitted_at < self._last_backoff:
+            return
+        self._consecutive_timeouts += 1
+        if self._consecutive_timeouts >= self.TIMEOUTS_BEFORE_BACKOFF and self.max_inflight > 1:
+            new_limit = self.max_inflight // 2
+            self._slot_debt += self.max_inflight - new_limit
+            self.max_inflight = new_limit
+            self._consecutive_timeouts = 0
+            self._last_backoff = time.monotonic()
+            self.logger.warning("Timeout beruntun di %s, max_inflight diturunkan ke %d", self.server_address, new_limit)
+
+
+class _ComfyUIServerBase(_InflightLimitMixin):
+    """Bagian bersama ComfyUIServer dan AsyncComfyUIServer: alamat, URL, dan decoding pesan websocket"""
+
+    # Berapa kali pembatalan prompt yang timeout dicoba sebelum slot-nya dilepas paksa
+    CANCEL_ATTEMPTS = 3
+
+    def __init__(self, server_address, logger, client_id=None, max_inflight=4):
         self.server_address = server_address
-        self.client_id = str(uuid.uuid4())
+        self.client_id = client_id or str(uuid.uuid4())
+        self.logger = logger
+        self._init_inflight_limit(max_inflight)
+        self._prompt_url = f"http://{server_address}/prompt"
+        self._history_url = f"http://{server_address}/history/"
+        self._queue_url = f"http://{server_address}/queue"
+        self._interrupt_url = f"http://{server_address}/interrupt"
+        self._ws_url = f"ws://{server_address}/ws?clientId={self.client_id}"
+
+    @staticmethod
+    def _completed_prompt_id(message):
+        """prompt_id dari pesan 'executing' dengan node None (prompt selesai), selain itu None"""
+        if not isinstance(message, str):
+            return None  # frame biner (preview gambar)
+        try:
+            msg = _json_loads(message)
+        except ValueError:
+            return None
+        if msg.get('type') == 'executing':
+            data = msg.get('data') or {}
+            if data.get('node') is None:
+                return data.get('prompt_id') or None
+        return None
+
+    @staticmethod
+    def _finished_in_history(history, prompt_id):
+        """Notifikasi yang terlewat selama websocket terputus dicek sekali lewat /history saat tersambung lagi"""
+        return bool(history) and prompt_id in history
+
+    @staticmethod
+    def _is_running(queue_state, prompt_id):
+        """Apakah prompt sedang dieksekusi menurut GET /queue (item: [nomor, prompt_id, ...])"""
+        return any(len(item) > 1 and item[1] == prompt_id for item in queue_state.get('queue_running', ()))
+
+    def _log_cancel_failed(self, prompt_id, error):
+        self.logger.error("Gagal membatalkan prompt %s di %s: %s", prompt_id, self.server_address, error)
+
+    def _log_ws_error(self, error):
+        self.logger.error("Websocket ComfyUI %s error: %s", self.server_address, error)
+
+    def _log_ws_reconnect(self, delay):
+        self.logger.warning("Koneksi websocket %s terputus, mencoba lagi dalam %s detik...", self.server_address, delay)
+
+
+class ComfyUIServer(_ComfyUIServerBase):
+    """Koneksi ke satu instance ComfyUI: session HTTP, websocket, dan pekerjaan yang sedang berjalan"""
+
+    def __init__(self, server_address, logger, completion_queue, client_id=None, max_inflight=4):
+        super().__init__(server_address, logger, client_id, max_inflight)
+        self.completion_queue = completion_queue
+        self._create_slots(threading.BoundedSemaphore)
+        self._http = self._create_http_session()
+
+        # Notifikasi selesai via websocket, prompt_id yang selesai masuk ke completion_queue
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._ws = None
+        self._ws_stop = threading.Event()
+        self._ws_thread = threading.Thread(target=self._ws_loop, name=f'comfyui-ws-{server_address}', daemon=True)
+        self._ws_thread.start()
+
+    def _create_http_session(self):
+        """Session HTTP dengan keep-alive dan connection pool ke ComfyUI"""
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+        )
+        session.mount('http://', adapter)
+        session.headers['Connection'] = 'keep-alive'
+        return session
+
+    def post_prompt(self, data):
+        """Mengirim body /prompt yang sudah diserialisasi (bytes JSON)"""
+        try:
+            resp = self._http.post(self._prompt_url, data=data, timeout=(3, 30))
+            resp.raise_for_status()
+            return resp.json()
+        except Exception as e:
+            self.logger.error("Gagal mengirim prompt ke ComfyUI: %s", e)
+            return None
+
+    def get_history(self, prompt_id):
+        """Mendapatkan riwayat dari ComfyUI"""
+        try:
+            resp = self._http.get(self._history_url + prompt_id, timeout=(3, 30))
+            resp.raise_for_status()
+            return resp.json()
+        except Exception:
+            return None
+
+    def cancel_prompt(self, prompt_id):
+        """Menghapus prompt dari antrian ComfyUI, atau menghentikannya bila sedang berjalan
+
+        /interrupt hanya dikirim bila prompt ini yang sedang berjalan, karena ComfyUI
+        versi lama mengabaikan prompt_id dan menghentikan apa pun yang berjalan.
+        Mengembalikan True bila server sudah tidak lagi mengerjakan prompt tersebut.
+        """
+        try:
+            resp = self._http.post(self._queue_url, data=_json_dumps({'delete': [prompt_id]}), timeout=(3, 30))
+            resp.raise_for_status()
+            resp = self._http.get(self._queue_url, timeout=(3, 30))
+            resp.raise_for_status()
+            if self._is_running(resp.json(), prompt_id):
+                resp = self._http.post(self._interrupt_url, data=_json_dumps({'prompt_id': prompt_id}), timeout=(3, 30))
+                resp.raise_for_status()
+            return True
+        except Exception as e:
+            self._log_cancel_failed(prompt_id, e)
+            return False
+
+    @property
+    def inflight(self):
+        """Jumlah prompt yang sudah diantrikan ke server ini dan belum selesai"""
+        return len(self._pending)
+
+    def try_acquire_slot(self):
+        return self._slots.acquire(blocking=False)
+
+    def track(self, prompt_id):
+        with self._pending_lock:
+            self._pending.add(prompt_id)
+
+    def untrack(self, prompt_id):
+        """Melepas prompt yang selesai/timeout beserta slot-nya"""
+        with self._pending_lock:
+            self._pending.discard(prompt_id)
+        self.release_slot()
+
+    def _ws_loop(self):
+        """Menjaga koneksi websocket ke ComfyUI, reconnect dengan exponential backoff"""
+        self._ws_backoff = 1
+        while not self._ws_stop.is_set():
+            ws = websocket.WebSocketApp(
+                self._ws_url,
+                on_open=self._on_ws_open,
+                on_message=self._on_ws_message,
+                on_error=self._on_ws_error,
+            )
+            self._ws = ws
+            try:
+                # Ping berkala membangunkan dispatcher (agar close() tidak menggantung)
+                # dan mendeteksi koneksi yang mati tanpa ditutup
+                ws.run_forever(ping_interval=10, ping_timeout=5)
+            except Exception as e:
+                self._log_ws_error(e)
+            finally:
+                # Selalu tutup sebelum membuka ulang, koneksi lama bisa menggantung
+                ws.close()
+            if self._ws_stop.is_set():
+                break
+            self._log_ws_reconnect(self._ws_backoff)
+            self._ws_stop.wait(self._ws_backoff)
+            self._ws_backoff = min(self._ws_backoff * 2, 60)
+
+    def _on_ws_open(self, ws):
+        self._ws_backoff = 1
+        with self._pending_lock:
+            pending = list(self._pending)
+        for prompt_id in pending:
+            history = self.get_history(prompt_id)
+            if self._finished_in_history(history, prompt_id):
+                self.completion_queue.put(prompt_id)
+
+    def _on_ws_message(self, ws, message):
+        prompt_id = self._completed_prompt_id(message)
+        if prompt_id is not None:
+            self.completion_queue.put(prompt_id)
+
+    def _on_ws_error(self, ws, error):
+        self._log_ws_error(error)
+
+    def close(self):
+        """Menutup koneksi websocket dan session HTTP ke ComfyUI"""
+        self._ws_stop.set()
+        if self._ws is not None:
+            self._ws.close()
+        self._ws_thread.join(timeout=5)
+        self._http.close()
+
+
+class _BatchProcessorBase:
+    """Bagian yang sama untuk pemroses threaded dan asyncio: parsing, template, body /prompt"""
+
+    def __init__(self, server_addresses=("127.0.0.1:8188",), max_inflight=None, timeout=600):
+        if isinstance(server_addresses, str):
+            server_addresses = [server_addresses]
+        self.timeout = timeout
         log_dir = Path('logs')
         log_dir.mkdir(exist_ok=True)
+        log_format = '%(asctime)s - %(levelname)s - %(message)s'
+        # Log file ditampung di memori dan ditulis per 200 record (langsung bila ERROR)
+        file_target = logging.FileHandler(log_dir / 'batch_process_v2.log')
+        file_target.setFormatter(logging.Formatter(log_format))
+        file_handler = logging.handlers.MemoryHandler(capacity=200, flushLevel=logging.ERROR, target=file_target)
+        logging.raiseExceptions = False
         logging.basicConfig(
             level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
+            format=log_format,
             handlers=[
-                logging.FileHandler(log_dir / 'batch_process_v2.log'),
+                file_handler,
                 logging.StreamHandler()
             ]
         )
         self.logger = logging.getLogger(__name__)
+        if max_inflight is None:
+            max_inflight = self._max_inflight_from_env()
+        self.max_inflight = max(1, max_inflight)
         
         # --- PERUBAHAN UTAMA DIMULAI DI SINI ---
+        self._workflow_cache = {}
+        self._mutation_sites = {}
+        self._body_templates = {}
+        self._getrandbits = random.Random().getrandbits
         self.workflows = self._discover_workflows()
 
+        # Satu koneksi per instance ComfyUI (beda port/GPU)
+        # client_id dipakai bersama semua server agar body /prompt bisa disiapkan sebelum server dipilih
+        self.client_id = str(uuid.uuid4())
+        self.servers = self._create_servers(server_addresses)
+
+    def _max_inflight_from_env(self):
+        """max_inflight dari COMFY_MAX_INFLIGHT, default 4 bila kosong atau tidak valid"""
+        raw = os.environ.get('COMFY_MAX_INFLIGHT') or '4'
+        try:
+            return int(raw)
+        except ValueError:
+            self.logger.error(f"Nilai COMFY_MAX_INFLIGHT tidak valid: '{raw}', memakai default 4")
+            return 4
+
+    def _create_servers(self, server_addresses):
+        """Membuat objek koneksi per alamat server (diimplementasikan subclass)"""
+        raise NotImplementedError
+
     def _discover_workflows(self):
         """Secara otomatis memindai folder 'workflows' dan mendaftarkan semua file .json."""
         workflows_dir = Path('workflows')
@@ -43,6 +388,11 @@ class ComfyUIBatchProcessorV2:
             workflow_name = workflow_file.stem
             discovered[workflow_name] = str(workflow_file)
             self.logger.info(f" -> Ditemukan: '{workflow_name}' (dari file: {workflow_file.name})")
+            # Parse sekali di awal, bukan per gambar
+            try:
+                self._cache_workflow(workflow_name, _json_loads(workflow_file.read_bytes()))
+            except ValueError as e:
+                self.logger.error(f"Workflow '{workflow_name}' bukan JSON yang valid: {e}")
         
         if not discovered:
             self.logger.warning("PERINGATAN: Tidak ada workflow .json yang ditemukan di dalam folder 'workflows'.")
@@ -54,152 +404,521 @@ class ComfyUIBatchProcessorV2:
         """Parser untuk format [∆{workflow}•jumlah∆ ¥prompt¥]"""
         prompts = []
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                for line_num, line in enumerate(f, 1):
-                    line = line.strip()
-                    if not line.startswith('[') or not line.endswith(']'):
+            # File prompt kecil dibanding RAM: baca sekaligus dengan buffer besar, decode sekali
+            with open(filepath, 'rb', buffering=1 << 20) as f:
+                data = f.read().decode('utf-8')
+            for line_num, line in enumerate(data.splitlines(), 1):
+                line = line.strip()
+                if line[:1] != '[' or line[-1:] != ']':
+                    continue
+                
+                try:
+                    content = line[1:-1]
+                    parts = content.split(_SPLIT_SEP)
+                    if len(parts) != 2:
+                        self.logger.warning(f"Format tidak valid di baris {line_num}: Tanda '¥' tidak ditemukan atau lebih dari satu.")
                         continue
-                    
-                    try:
-                        content = line[1:-1]
-                        parts = content.split(' ¥')
-                        if len(parts) != 2:
-                            self.logger.warning(f"Format tidak valid di baris {line_num}: Tanda '¥' tidak ditemukan atau lebih dari satu.")
-                            continue
-                            
-                        workflow_part, prompt_text = parts
-                        prompt_text = prompt_text.rstrip('¥').strip()
                         
-                        workflow_pattern = r'∆\{([^}]+)\}•(\d+)∆'
-                        matches = re.findall(workflow_pattern, workflow_part)
-                        
-                        if not matches:
-                            self.logger.warning(f"Format workflow tidak ditemukan di baris {line_num}: {line}")
-                            continue
+                    workflow_part, prompt_text = parts
+                    prompt_text = prompt_text.rstrip('¥').strip()
+                    
+                    matches = _parse_workflow_part(workflow_part)
+                    
+                    if not matches:
+                        self.logger.warning(f"Format workflow tidak ditemukan di baris {line_num}: {line}")
+                        continue
 
-                        ratios = [{'type': name.strip(), 'count': int(count)} for name, count in matches]
-                        
-                        prompts.append({
-                            'text': prompt_text,
-                            'ratios': ratios,
-                            'line_num': line_num
-                        })
-
-                    except Exception as e:
-                        self.logger.error(f"Error mem-parsing baris {line_num}: {line} | Error: {e}")
+                    ratios = [{'type': name.strip(), 'count': int(count)} for name, count in matches]
+                    
+                    prompts.append({
+                        'text': prompt_text,
+                        'ratios': ratios,
+                        'line_num': line_num
+                    })
+
+                except Exception as e:
+                    self.logger.error(f"Error mem-parsing baris {line_num}: {line} | Error: {e}")
         except FileNotFoundError:
             self.logger.error(f"File prompt tidak ditemukan: {filepath}")
         return prompts
 
-    def load_workflow(self, workflow_type):
-        """Memuat file workflow JSON (Sudah dinamis)"""
-        workflow_path = self.workflows.get(workflow_type)
-        if not workflow_path:
-            self.logger.error(f"Nama workflow '{workflow_type}' tidak ditemukan. Pastikan file '{workflow_type}.json' ada di folder 'workflows'.")
-            raise FileNotFoundError(f"Workflow {workflow_type} tidak ditemukan")
-        with open(workflow_path, 'r') as f:
-            return json.load(f)
-
-    def update_workflow_prompt(self, workflow, prompt_text):
-        """Memperbarui prompt text dan seed di dalam workflow"""
-        for node_data in workflow.values():
+    def _get_template(self, workflow_type):
+        """Template workflow yang di-cache (bukan salinan)"""
+        template = self._workflow_cache.get(workflow_type)
+        if template is None:
+            workflow_path = self.workflows.get(workflow_type)
+            if not workflow_path:
+                self.logger.error(f"Nama workflow '{workflow_type}' tidak ditemukan. Pastikan file '{workflow_type}.json' ada di folder 'workflows'.")
+                raise FileNotFoundError(f"Workflow {workflow_type} tidak ditemukan")
+            with open(workflow_path, 'rb') as f:
+                template = self._cache_workflow(workflow_type, _json_loads(f.read()))
+        return template
+
+    def _cache_workflow(self, workflow_type, template):
+        """Menyimpan template beserta lokasi node yang diubah per gambar"""
+        self._mutation_sites[workflow_type] = self._find_mutation_sites(template)
+        self._workflow_cache[workflow_type] = template
+        return template
+
+    @staticmethod
+    def _find_mutation_sites(workflow):
+        """Mencari node CLIPTextEncode (text) dan KSampler (seed) sekali per template"""
+        text_nodes, seed_nodes = [], []
+        for node_id, node_data in workflow.items():
             if isinstance(node_data, dict):
                 if node_data.get('class_type') == 'CLIPTextEncode' and 'inputs' in node_data and 'text' in node_data['inputs']:
-                    node_data['inputs']['text'] = prompt_text
+                    text_nodes.append(node_id)
                 if node_data.get('class_type') == 'KSampler' and 'inputs' in node_data:
-                    node_data['inputs']['seed'] = random.randint(1, 10**15)
-        return workflow
+                    seed_nodes.append(node_id)
+        return {'text_nodes': text_nodes, 'seed_nodes': seed_nodes}
 
-    def queue_prompt(self, workflow):
-        """Mengirim pekerjaan ke antrian ComfyUI"""
-        p = {"prompt": workflow, "client_id": self.client_id}
-        data = json.dumps(p).encode('utf-8')
-        try:
-            resp = requests.post(f"http://{self.server_address}/prompt", data=data)
-            resp.raise_for_status()
-            return resp.json()
-        except Exception as e:
-            self.logger.error(f"Gagal mengirim prompt ke ComfyUI: {e}")
-            return None
+    def _get_body_template(self, workflow_type):
+        """Body /prompt yang diserialisasi sekali, dengan penanda di posisi text dan seed"""
+        body_template = self._body_templates.get(workflow_type)
+        if body_template is None:
+            workflow = _copy_workflow(self._get_template(workflow_type))
+            sites = self._mutation_sites[workflow_type]
+            for node_id in sites['text_nodes']:
+                workflow[node_id]['inputs']['text'] = _TEXT_SENTINEL
+            seed_keys = []
+            for n, node_id in enumerate(sites['seed_nodes']):
+                sentinel = _SEED_SENTINEL.format(n)
+                workflow[node_id]['inputs']['seed'] = sentinel
+                seed_keys.append(_json_dumps(sentinel))
+            body = _json_dumps({"prompt": workflow, "client_id": self.client_id})
+            body_template = self._body_templates[workflow_type] = (body, _json_dumps(_TEXT_SENTINEL), seed_keys)
+        return body_template
 
-    def get_history(self, prompt_id):
-        """Mendapatkan riwayat dari ComfyUI"""
-        try:
-            resp = requests.get(f"http://{self.server_address}/history/{prompt_id}")
-            resp.raise_for_status()
-            return resp.json()
-        except Exception:
-            return None
+    def build_prompt_body(self, workflow_type, prompt_text):
+        """Body POST /prompt (bytes) untuk satu gambar
 
-    def wait_for_completion(self, prompt_id, timeout=600):
-        """Menunggu pekerjaan selesai"""
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            history = self.get_history(prompt_id)
-            if history and prompt_id in history:
-                return True
-            time.sleep(2)
-        return False
+        Graph workflow tidak diserialisasi ulang: hanya penanda di body template
+        yang diganti dengan seed baru dan prompt text yang sudah di-escape JSON.
+        """
+        body, text_key, seed_keys = self._get_body_template(workflow_type)
+        getrandbits = self._getrandbits
+        for key in seed_keys:
+            body = body.replace(key, b'%d' % (getrandbits(50) or 1))
+        return body.replace(text_key, _json_dumps(prompt_text))
 
-    def process_prompts(self, prompt_file):
-        """Memproses semua prompt dari file"""
+    def plan_generations(self, prompt_file):
+        """Menyusun seluruh rencana generate: list (ratio_type, prompt_text, i, count)"""
         prompts = self.parse_prompt_file(prompt_file)
         if not prompts:
             self.logger.info("Tidak ada prompt valid untuk diproses.")
-            return
+            return []
 
         total_generations = sum(sum(r['count'] for r in p['ratios']) for p in prompts)
         self.logger.info(f"Memulai proses {len(prompts)} baris prompt dengan total {total_generations} gambar.")
 
-        completed, failed = 0, 0
-        for prompt_idx, prompt_data in enumerate(prompts):
+        plan = []
+        for prompt_data in prompts:
             prompt_text = prompt_data['text']
-            self.logger.info(f"\nMemproses baris {prompt_idx + 1}/{len(prompts)}: {prompt_text[:70]}...")
-            
             for ratio_data in prompt_data['ratios']:
                 ratio_type = ratio_data['type']
                 count = ratio_data['count']
                 for i in range(count):
-                    try:
-                        workflow = self.load_workflow(ratio_type)
-                        workflow = self.update_workflow_prompt(workflow, prompt_text)
-                        
-                        result = self.queue_prompt(workflow)
-                        if result and 'prompt_id' in result:
-                            prompt_id = result['prompt_id']
-                            self.logger.info(f" - Generating ({ratio_type}) {i+1}/{count} (ID: {prompt_id})")
-                            
-                            if self.wait_for_completion(prompt_id):
-                                completed += 1
-                                self.logger.info(f"   Selesai: {ratio_type} {i+1}/{count}")
-                            else:
-                                failed += 1
-                                self.logger.error(f"   X Timeout: {ratio_type} {i+1}/{count}")
-                        else:
-                            failed += 1
-                            self.logger.error(f"   X Gagal antri: {ratio_type} {i+1}/{count}")
-                        time.sleep(2) 
-                    
-                    except Exception as e:
-                        failed += 1
-                        self.logger.error(f"   X Error Kritis pada ({ratio_type}): {e}")
+                    plan.append((ratio_type, prompt_text, i, count))
+        return plan
+
+
+class ComfyUIBatchProcessorV2(_BatchProcessorBase):
+    """Pemroses batch threaded: websocket per server di thread latar, satu loop pengirim"""
+
+    def __init__(self, server_addresses=("127.0.0.1:8188",), max_inflight=None, timeout=600):
+        # Semua server melapor prompt_id yang selesai ke satu antrian
+        self._completion_queue = queue.Queue()
+        self._inflight = {}
+        super().__init__(server_addresses, max_inflight, timeout)
+
+    def _create_servers(self, server_addresses):
+        return [ComfyUIServer(address, self.logger, self._completion_queue, self.client_id, self.max_inflight)
+                for address in server_addresses]
+
+    def _pick_server(self):
+        """Memilih server paling senggang dan mengambil satu slotnya, atau None bila semua penuh"""
+        for server in sorted(self.servers, key=lambda srv: srv.inflight):
+            if server.try_acquire_slot():
+                return server
+        return None
+
+    def _prefetch_workflows(self, plan, prepared):
+        """Thread produser: menyiapkan body /prompt siap kirim selagi GPU bekerja"""
+        for job in plan:
+            ratio_type, prompt_text = job[0], job[1]
+            try:
+                body = self.build_prompt_body(ratio_type, prompt_text)
+            except Exception as e:
+                prepared.put((job, None, e))
+            else:
+                prepared.put((job, body, None))
+
+    def _submit_generation(self, server, body, ratio_type, prompt_text, i, count):
+        """Mengantrikan satu gambar ke server; mengembalikan prompt_id atau None"""
+        result = server.post_prompt(body)
+        if not result or 'prompt_id' not in result:
+            self.logger.error("   X Gagal antri: %s %d/%d (%s)", ratio_type, i + 1, count, server.server_address)
+            return None
+
+        prompt_id = result['prompt_id']
+        server.track(prompt_id)
+        # (server, job, deadline, percobaan pembatalan; 0 selama belum timeout)
+        self._inflight[prompt_id] = (server, (ratio_type, prompt_text, i, count), time.monotonic() + self.timeout, 0)
+        self.logger.info(" - Generating (%s) %d/%d (ID: %s, %s): %.70s...", ratio_type, i + 1, count, prompt_id, server.server_address, prompt_text)
+        return prompt_id
+
+    def _expire_inflight(self):
+        """Menggugurkan pekerjaan yang melewati batas waktu; mengembalikan jumlahnya
+
+        Prompt yang timeout dibatalkan di server. Selama pembatalan gagal, slot-nya
+        tetap dipegang (agar tidak menumpuk antrian di ComfyUI) dan dicoba lagi
+        setelah satu periode timeout, kecuali notifikasi selesainya datang lebih dulu.
+        """
+        now = time.monotonic()
+        expired = [pid for pid, (_, _, deadline, _) in self._inflight.items() if deadline <= now]
+        failed = 0
+        for prompt_id in expired:
+            server, job, deadline, attempts = self._inflight.pop(prompt_id)
+            if not attempts:
+                ratio_type, _, i, count = job
+                server.record_result(False, deadline - self.timeout)
+                self.logger.error("   X Timeout: %s %d/%d (%s)", ratio_type, i + 1, count, server.server_address)
+                failed += 1
+            attempts += 1
+            if server.cancel_prompt(prompt_id):
+                server.untrack(prompt_id)
+            elif attempts >= server.CANCEL_ATTEMPTS:
+                self.logger.warning("Prompt %s di %s tetap tidak bisa dibatalkan, slot-nya dilepas", prompt_id, server.server_address)
+                server.untrack(prompt_id)
+            else:
+                self._inflight[prompt_id] = (server, job, now + self.timeout, attempts)
+        return failed
+
+    def process_prompts(self, prompt_file):
+        """Memproses semua prompt dari file"""
+        plan = self.plan_generations(prompt_file)
+        if not plan:
+            return
+
+        # Isi + serialisasi workflow di thread terpisah, sehingga yang tersisa di
+        # jalur kirim hanya POST /prompt
+        prepared = queue.Queue(maxsize=len(self.servers) * self.max_inflight * 2)
+        threading.Thread(target=self._prefetch_workflows, args=(plan, prepared), name='comfyui-prefetch', daemon=True).start()
+
+        # Isi slot kosong (semaphore max_inflight per server), lalu tunggu prompt
+        # mana pun yang selesai lebih dulu dari completion_queue
+        remaining = len(plan)
+        completed, failed = 0, 0
+        while remaining or self._inflight:
+            while remaining:
+                server = self._pick_server()
+                if server is None:
+                    break
+                (ratio_type, prompt_text, i, count), body, error = prepared.get()
+                remaining -= 1
+                try:
+                    if error is not None:
+                        raise error
+                    prompt_id = self._submit_generation(server, body, ratio_type, prompt_text, i, count)
+                except Exception as e:
+                    prompt_id = None
+                    self.logger.error("   X Error Kritis pada (%s): %s", ratio_type, e)
+                if prompt_id is None:
+                    failed += 1
+                    server.release_slot()
+            if not self._inflight:
+                continue
+
+            next_deadline = min(deadline for _, _, deadline, _ in self._inflight.values())
+            try:
+                done_id = self._completion_queue.get(timeout=max(next_deadline - time.monotonic(), 0))
+            except queue.Empty:
+                failed += self._expire_inflight()
+                continue
+
+            entry = self._inflight.pop(done_id, None)
+            if entry is None:
+                continue  # notifikasi ganda atau pekerjaan yang sudah dibatalkan
+            server, (ratio_type, _, i, count), _, attempts = entry
+            server.untrack(done_id)
+            if attempts:
+                continue  # sudah dihitung gagal; yang tertunda hanya pelepasan slot
+            server.record_result(True)
+            completed += 1
+            self.logger.info("   Selesai: %s %d/%d", ratio_type, i + 1, count)
+
+        self.logger.info(f"\n{'='*50}")
+        self.logger.info(f"SELESAI! Total: {len(plan)}, Berhasil: {completed}, Gagal: {failed}")
 
+    def close(self):
+        """Menutup semua koneksi ke ComfyUI"""
+        for server in self.servers:
+            server.close()
+
+
+class AsyncComfyUIServer(_ComfyUIServerBase):
+    """Versi asyncio dari ComfyUIServer: aiohttp untuk HTTP, websockets untuk notifikasi selesai"""
+
+    def __init__(self, server_address, logger, client_id=None, max_inflight=4):
+        # Semaphore dibuat di start(): di Python < 3.10 ia terikat ke loop saat dibuat
+        super().__init__(server_address, logger, client_id, max_inflight)
+        self._futures = {}
+        # Prompt yang sudah di-POST tapi belum ditunggu, dan yang selesai sebelum sempat ditunggu
+        self._posted = set()
+        self._posting = 0
+        self._finished = set()
+        self._http = None
+        self._ws_task = None
+
+    async def acquire_slot(self):
+        await self._slots.acquire()
+
+    async def start(self):
+        """Membuka semaphore slot, session HTTP dan task pembaca websocket (harus di dalam event loop)"""
+        import aiohttp
+        self._create_slots(asyncio.BoundedSemaphore)
+        self._http = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=16),
+            timeout=aiohttp.ClientTimeout(total=30, sock_connect=3),
+        )
+        self._ws_task = asyncio.create_task(self._ws_loop())
+
+    async def _ws_loop(self):
+        """Satu consumer untuk semua notifikasi server ini, reconnect dengan exponential backoff"""
+        import websockets
+        backoff = 1
+        while True:
+            try:
+                # Ping berkala mendeteksi koneksi yang menggantung tanpa ditutup; max_size=None
+                # karena frame gambar biner dari ComfyUI bisa melebihi batas default 1 MiB
+                async with websockets.connect(self._ws_url, ping_interval=20, ping_timeout=10, close_timeout=2,
+                                              max_size=None) as ws:
+                    backoff = 1
+                    await self._recheck_pending()
+                    async for message in ws:
+                        self._on_ws_message(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._log_ws_error(e)
+            self._log_ws_reconnect(backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+    async def _recheck_pending(self):
+        for prompt_id in list(self._futures):
+            history = await self.get_history(prompt_id)
+            if self._finished_in_history(history, prompt_id):
+                self._resolve(prompt_id)
+
+    def _on_ws_message(self, message):
+        prompt_id = self._completed_prompt_id(message)
+        if prompt_id is not None:
+            self._resolve(prompt_id)
+
+    def _resolve(self, prompt_id):
+        future = self._futures.get(prompt_id)
+        if future is None:
+            # Selesai sebelum wait_for_completion sempat mendaftar. Selagi POST masih
+            # berjalan prompt_id-nya belum diketahui, jadi sementara dicatat juga;
+            # notifikasi untuk prompt yang sudah timeout diabaikan.
+            if prompt_id in self._posted or self._posting:
+                self._finished.add(prompt_id)
+        elif not future.done():
+            future.set_result(True)
+
+    async def post_prompt(self, data):
+        """Mengirim body /prompt yang sudah diserialisasi (bytes JSON)"""
+        self._posting += 1
+        try:
+            async with self._http.post(self._prompt_url, data=data, headers={'Content-Type': 'application/json'}) as resp:
+                resp.raise_for_status()
+                result = await resp.json(loads=_json_loads)
+        except Exception as e:
+            self.logger.error("Gagal mengirim prompt ke ComfyUI: %s", e)
+            result = None
+        finally:
+            self._posting -= 1
+        if result and 'prompt_id' in result:
+            self._posted.add(result['prompt_id'])
+        if not self._posting:
+            # Catatan sementara milik prompt yang tidak akan ditunggu dibuang
+            self._finished &= self._posted
+        return result
+
+    async def get_history(self, prompt_id):
+        """Mendapatkan riwayat dari ComfyUI"""
+        try:
+            async with self._http.get(self._history_url + prompt_id) as resp:
+                resp.raise_for_status()
+                return await resp.json(loads=_json_loads)
+        except Exception:
+            return None
+
+    async def cancel_prompt(self, prompt_id):
+        """Versi async dari ComfyUIServer.cancel_prompt"""
+        headers = {'Content-Type': 'application/json'}
+        try:
+            async with self._http.post(self._queue_url, data=_json_dumps({'delete': [prompt_id]}), headers=headers) as resp:
+                resp.raise_for_status()
+            async with self._http.get(self._queue_url) as resp:
+                resp.raise_for_status()
+                queue_state = await resp.json(loads=_json_loads)
+            if self._is_running(queue_state, prompt_id):
+                async with self._http.post(self._interrupt_url, data=_json_dumps({'prompt_id': prompt_id}), headers=headers) as resp:
+                    resp.raise_for_status()
+            return True
+        except Exception as e:
+            self._log_cancel_failed(prompt_id, e)
+            return False
+
+    async def wait_for_completion(self, prompt_id, timeout=600):
+        """Menunggu pekerjaan selesai (future di-resolve oleh pembaca websocket)"""
+        self._posted.discard(prompt_id)
+        if prompt_id in self._finished:
+            self._finished.discard(prompt_id)
+            return True
+        future = self._futures[prompt_id] = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._futures.pop(prompt_id, None)
+
+    async def close(self):
+        """Menutup task websocket dan session HTTP"""
+        if self._ws_task is not None:
+            self._ws_task.cancel()
+            try:
+                await self._ws_task
+            except asyncio.CancelledError:
+                pass
+        if self._http is not None:
+            await self._http.close()
+
+
+class AsyncComfyUIBatchProcessor(_BatchProcessorBase):
+    """Pemroses batch berbasis asyncio: satu thread, tanpa thread per websocket/pekerjaan"""
+
+    def _create_servers(self, server_addresses):
+        return [AsyncComfyUIServer(address, self.logger, self.client_id, self.max_inflight) for address in server_addresses]
+
+    def process_prompts(self, prompt_file):
+        """Memproses semua prompt dari file (event loop uvloop bila terpasang)"""
+        try:
+            import uvloop
+        except ImportError:  # uvloop opsional (tidak tersedia di Windows)
+            uvloop = None
+        if uvloop is not None and hasattr(uvloop, 'run'):
+            uvloop.run(self.process_prompts_async(prompt_file))
+        elif uvloop is not None:
+            uvloop.install()
+            asyncio.run(self.process_prompts_async(prompt_file))
+        else:
+            asyncio.run(self.process_prompts_async(prompt_file))
+
+    async def process_prompts_async(self, prompt_file):
+        plan = self.plan_generations(prompt_file)
+        if not plan:
+            return
+
+        jobs = asyncio.Queue()
+        for job in plan:
+            jobs.put_nowait(job)
+
+        for server in self.servers:
+            await server.start()
+        try:
+            # max_inflight worker per server; server yang cepat kosong lebih cepat
+            # dan otomatis mengambil lebih banyak pekerjaan
+            workers = [self._worker(server, jobs) for server in self.servers for _ in range(server.max_inflight)]
+            results = await asyncio.gather(*workers)
+        finally:
+            for server in self.servers:
+                await server.close()
+
+        completed = sum(results)
         self.logger.info(f"\n{'='*50}")
-        self.logger.info(f"SELESAI! Total: {total_generations}, Berhasil: {completed}, Gagal: {failed}")
+        self.logger.info(f"SELESAI! Total: {len(plan)}, Berhasil: {completed}, Gagal: {len(plan) - completed}")
+
+    async def _worker(self, server, jobs):
+        """Mengambil pekerjaan dari antrian bersama hanya saat server punya slot kosong"""
+        completed = 0
+        while True:
+            await server.acquire_slot()
+            try:
+                try:
+                    job = jobs.get_nowait()
+                except asyncio.QueueEmpty:
+                    return completed
+                if await self._run_generation(server, *job):
+                    completed += 1
+            finally:
+                server.release_slot()
+
+    async def _cancel_timed_out(self, server, prompt_id):
+        """Membatalkan prompt yang timeout di server; slot worker tetap dipegang sampai
+        pembatalan berhasil atau prompt ternyata selesai (lihat ComfyUIBatchProcessorV2._expire_inflight)"""
+        attempts = 0
+        while not await server.cancel_prompt(prompt_id):
+            attempts += 1
+            if attempts >= server.CANCEL_ATTEMPTS:
+                self.logger.warning("Prompt %s di %s tetap tidak bisa dibatalkan, slot-nya dilepas", prompt_id, server.server_address)
+                return
+            if await server.wait_for_completion(prompt_id, self.timeout):
+                return
+
+    async def _run_generation(self, server, ratio_type, prompt_text, i, count):
+        """Mengantrikan satu gambar ke server lalu menunggu sampai selesai"""
+        try:
+            body = self.build_prompt_body(ratio_type, prompt_text)
+            submitted_at = time.monotonic()
+            result = await server.post_prompt(body)
+            if not result or 'prompt_id' not in result:
+                self.logger.error("   X Gagal antri: %s %d/%d (%s)", ratio_type, i + 1, count, server.server_address)
+                return False
+
+            prompt_id = result['prompt_id']
+            self.logger.info(" - Generating (%s) %d/%d (ID: %s, %s): %.70s...", ratio_type, i + 1, count, prompt_id, server.server_address, prompt_text)
+            finished = await server.wait_for_completion(prompt_id, self.timeout)
+            server.record_result(finished, submitted_at)
+            if finished:
+                self.logger.info("   Selesai: %s %d/%d", ratio_type, i + 1, count)
+                return True
+            self.logger.error("   X Timeout: %s %d/%d (%s)", ratio_type, i + 1, count, server.server_address)
+            await self._cancel_timed_out(server, prompt_id)
+            return False
+        except Exception as e:
+            self.logger.error("   X Error Kritis pada (%s): %s", ratio_type, e)
+            return False
 
 if __name__ == "__main__":
     import sys
     
-    if len(sys.argv) < 2:
-        print("Usage: python comfyui_batch_processor_v2.py <prompt_file.txt>")
+    # --async: pakai AsyncComfyUIBatchProcessor (aiohttp + websockets)
+    use_async = '--async' in sys.argv[1:]
+    args = [arg for arg in sys.argv[1:] if arg != '--async']
+    if not args:
+        print("Usage: python comfyui_batch_processor_v2.py [--async] <prompt_file.txt> [host:port ...]")
         sys.exit(1)
             
-    prompt_file = sys.argv[1]
+    prompt_file = args[0]
     if not os.path.exists(prompt_file):
         print(f"File tidak ditemukan: {prompt_file}")
         sys.exit(1)
             
-    processor = ComfyUIBatchProcessorV2()
-    processor.process_prompts(prompt_file)
+    # Alamat server tambahan opsional, default satu instance lokal
+    server_addresses = args[1:] or ["127.0.0.1:8188"]
+    if use_async:
+        # Koneksi async dibuka dan ditutup di dalam process_prompts
+        AsyncComfyUIBatchProcessor(server_addresses).process_prompts(prompt_file)
+    else:
+        processor = ComfyUIBatchProcessorV2(server_addresses)
+        try:
+            processor.process_prompts(prompt_file)
+        finally:
+            processor.close()
 
                                                 